@@ -1,18 +1,27 @@
 from getpass import getpass
 
 from flask.cli import with_appcontext
+from sqlalchemy import text
 
 from solid.cli import cli_bp
 from solid.db import User
 from solid.extensions import db
-from solid.webserver import webserver_bp, create_app
-from trompasolid.db import Base
+from solid.webserver import webserver_bp, create_app, warm_provider_caches
+from trompasolid.db import Base, SCHEMA_UPGRADE_STATEMENTS
 
 app = create_app()
 
 app.register_blueprint(webserver_bp)
 app.register_blueprint(cli_bp)
 
+try:
+    # Only importable when running under uwsgi. flask cli commands don't need the caches
+    import uwsgi  # noqa: F401
+except ImportError:
+    pass
+else:
+    warm_provider_caches(app)
+
 
 @app.cli.command("create-db")
 def create_database():
@@ -25,6 +34,16 @@ def create_database():
     print("Done")
 
 
+@app.cli.command("upgrade-db")
+def upgrade_database():
+    """Update the tables of a database made by an older version"""
+    print("Upgrading database tables...")
+    with db.engine.begin() as connection:
+        for statement in SCHEMA_UPGRADE_STATEMENTS:
+            connection.execute(text(statement))
+    print("Done")
+
+
 @app.cli.command("create-user")
 @with_appcontext
 def create_user():
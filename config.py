@@ -11,6 +11,9 @@ REDIRECT_URL = os.getenv("CONFIG_REDIRECT_URL")
 
 BASE_URL = os.getenv("CONFIG_BASE_URL")
 
+# Don't verify TLS certificates of providers. Only use this when testing against a local provider
+INSECURE_TLS = os.getenv("CONFIG_INSECURE_TLS", "false").lower() == "true"
+
 # When accessing an OP, should you register a client ID ahead of time, or submit a URL?
 #  if the OP doesn't support client registration, it'll always submit a URL
 ALWAYS_USE_CLIENT_URL = False
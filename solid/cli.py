@@ -1,11 +1,8 @@
-import json
-
 import click
-import jwcrypto.jwk
-import jwcrypto.jwt
 from flask import Blueprint, current_app
 
 from trompasolid import solid
+from trompasolid.authentication import get_provider_key
 from solid import extensions
 from trompasolid.backend import SolidBackend
 from trompasolid.backend.db_backend import DBBackend
@@ -33,6 +30,7 @@ def create_key():
         return
     keys = solid.generate_keys()
     get_backend().save_relying_party_keys(keys)
+    get_backend().commit()
 
 
 @cli_bp.cli.command('lookup-op')
@@ -49,18 +47,17 @@ def lookup_op_configuration(profileurl):
         return
     print(f"Provider for this user is: {provider}")
 
-    provider_configuration = get_backend().get_resource_server_configuration(provider)
-    provider_keys = get_backend().get_resource_server_keys(provider)
+    bundle = get_backend().get_provider_bundle(provider)
 
-    if provider_configuration and provider_keys:
+    if bundle["configuration"] and bundle["keys"]:
         print(f"Configuration for {provider} already exists, quitting")
         return
 
     openid_conf = solid.get_openid_configuration(provider)
     get_backend().save_resource_server_configuration(provider, openid_conf)
-
     provider_keys = solid.load_op_jwks(openid_conf)
     get_backend().save_resource_server_keys(provider, provider_keys)
+    get_backend().commit()
 
 
 @cli_bp.cli.command()
@@ -69,13 +66,14 @@ def register(provider):
     """Step 3, Register with the OP.
     Pass in the provider url from `lookup-op`"""
 
-    provider_config = get_backend().get_resource_server_configuration(provider)
+    bundle = get_backend().get_provider_bundle(provider)
+    provider_config = bundle["configuration"]
 
     if not provider_config:
         print("No configuration exists for this provider, use `lookup-op` first")
         return
 
-    existing_registration = get_backend().get_client_registration(provider)
+    existing_registration = bundle["registration"]
     if existing_registration:
         print(f"Registration for {provider} already exists, quitting")
         return
@@ -85,14 +83,12 @@ def register(provider):
 
     if do_dynamic_registration:
         print(f"Requested to do dynamic client registration")
-        client_registration = get_backend().get_client_registration(provider)
-        if client_registration:
-            print(f"Registration for {provider} already exists, skipping")
-        else:
-            client_registration = solid.dynamic_registration(provider, current_app.config['REDIRECT_URL'], provider_config)
-            get_backend().save_client_registration(provider, client_registration)
-
-            print("Registered client with provider")
+        # We already returned above if a registration exists
+        client_registration = solid.dynamic_registration(provider, current_app.config['REDIRECT_URL'], provider_config)
+        get_backend().save_client_registration(provider, client_registration)
+        get_backend().commit()
+
+        print("Registered client with provider")
         client_id = client_registration["client_id"]
         print(f"Client ID is {client_id}")
     else:
@@ -108,7 +104,8 @@ def auth_request(profileurl):
 
     Provide a user's profile url
     """
-    provider = solid.lookup_provider_from_profile(profileurl)
+    # If we already have a token for this user we know their provider, otherwise look it up
+    provider = get_backend().get_issuer_for_profile(profileurl) or solid.lookup_provider_from_profile(profileurl)
     provider_configuration = get_backend().get_resource_server_configuration(provider)
     client_registration = get_backend().get_client_registration(provider)
     if client_registration is None:
@@ -120,7 +117,8 @@ def auth_request(profileurl):
     state = make_random_string()
 
     assert get_backend().get_state_data(state) is None
-    get_backend().set_state_data(state, code_verifier)
+    get_backend().set_state_data(state, code_verifier, provider)
+    get_backend().commit()
 
     auth_url = solid.generate_authorization_request(
         provider_configuration, current_app.config['REDIRECT_URL'],
@@ -140,6 +138,7 @@ def exchange_auth(provider, code, state):
     Provide a provider url, and the code and state that were returned in the redirect by the provider
     """
 
+    get_backend().prefetch(provider)
     client_registration = get_backend().get_client_registration(provider)
     if not client_registration:
         raise Exception("Expected to find a registration for a backend but can't get one")
@@ -147,33 +146,34 @@ def exchange_auth(provider, code, state):
 
     redirect_uri = current_app.config['REDIRECT_URL']
 
-    signing_algorithm = solid.get_signing_algorithm(provider_config)
-    code_verifier = get_backend().get_state_data(state)
-    keypair = solid.load_key(get_backend().get_relying_party_keys(signing_algorithm))
-    assert code_verifier is not None, f"state {state} not in backend?"
+    backend_state = get_backend().pop_state_data(state)
+    keypair = solid.load_key(get_backend().get_relying_party_keys())
+    assert backend_state is not None, f"state {state} not in backend?"
+    if backend_state["issuer"] not in (None, provider):
+        print(f"state {state} was created for a different provider")
+        return
+    code_verifier = backend_state["code_verifier"]
 
     client_id = client_registration['client_id']
     client_secret = client_registration['client_secret']
     auth = (client_id, client_secret)
-    success, resp = solid.validate_auth_callback(signing_algorithm, keypair, code_verifier, code, provider_config, client_id, redirect_uri, auth=auth)
+    success, resp = solid.validate_auth_callback(keypair, code_verifier, code, provider_config, client_id, redirect_uri, auth=auth)
 
     if success:
         print(resp)
         id_token = resp['id_token']
-        server_key = get_backend().get_resource_server_keys(provider)
-        # TODO: It seems like a server may give more than one key, is this the correct one?
-        key = server_key['keys'][0]
-        key = jwcrypto.jwk.JWK.from_json(json.dumps(key))
-        decoded_id_token = jwcrypto.jwt.JWT()
-        decoded_id_token.deserialize(id_token, key=key)
-
-        claims = json.loads(decoded_id_token.claims)
+        key = get_provider_key(get_backend(), provider, solid.get_jwt_kid(id_token))
+        if key is None:
+            print(f"Cannot find the key that signed the id token in the keys of {provider}")
+            return
+        claims = solid.verify_id_token(id_token, key, provider_config["issuer"], client_id)
 
         issuer = claims['iss']
         sub = claims['sub']
         print(claims)
 
         get_backend().save_configuration_token(issuer, profile=sub, sub=sub, token=resp)
+        get_backend().commit()
         print(f"Saved {issuer=}, {sub=}")
     else:
         print("No response - error when exchanging key")
@@ -182,9 +182,11 @@ def exchange_auth(provider, code, state):
 @cli_bp.cli.command()
 @click.argument('profile')
 def refresh(profile):
-    provider = solid.lookup_provider_from_profile(profile)
+    # A token for this profile is stored with its issuer, so we only need to look it up if we don't have one
+    provider = get_backend().get_issuer_for_profile(profile) or solid.lookup_provider_from_profile(profile)
     print(f"{profile=}")
     print(f"{provider=}")
+    get_backend().prefetch(provider)
     keypair = solid.load_key(get_backend().get_relying_party_keys())
     provider_info = get_backend().get_resource_server_configuration(provider)
 
@@ -201,6 +203,7 @@ def refresh(profile):
     if status and False:
         resp.update({"refresh_token": refresh_token})
         get_backend().update_configuration_token(provider, profile, resp)
+        get_backend().commit()
         print("Token updated")
     else:
         print(f"Failure updating token: {status}")
@@ -1,15 +1,19 @@
+import functools
+import json
+import zlib
 from typing import Optional
 
 import flask
-from flask import request, current_app, jsonify, session
+from flask import request, current_app, session
 from flask_login import login_user, login_required, logout_user
 
-import solid
 from solid.admin import init_admin
-from trompasolid.authentication import generate_authentication_url, NoProviderError, authentication_callback
+from trompasolid.authentication import generate_authentication_url, NoProviderError, authentication_callback, \
+    index_provider_keys
 from trompasolid.backend import SolidBackend
 from trompasolid.backend.db_backend import DBBackend
 from trompasolid.backend.redis_backend import RedisBackend
+from trompasolid import solid
 from solid import extensions
 from solid import db
 from solid.auth import is_safe_url, LoginForm
@@ -17,6 +21,18 @@ from solid.auth import is_safe_url, LoginForm
 backend: Optional[SolidBackend] = None
 
 
+def warm_provider_caches(app):
+    """Parse the keys of every provider that we already know about, so that the first login
+    with each of them after the server starts doesn't have to"""
+    with app.app_context():
+        if not backend.is_ready():
+            return
+        for provider in backend.list_known_providers():
+            keys = backend.get_resource_server_keys(provider)
+            if keys:
+                index_provider_keys(provider, keys)
+
+
 def create_app():
     app = flask.Flask(__name__, template_folder="../templates")
     app.config.from_pyfile("../config.py")
@@ -26,6 +42,8 @@ def create_app():
     extensions.login_manager.init_app(app)
     init_admin()
 
+    solid.set_tls_verification(not app.config["INSECURE_TLS"])
+
     global backend
     if app.config["BACKEND"] == "db":
         backend = DBBackend(extensions.db.session)
@@ -43,6 +61,7 @@ def create_app():
                 print("On startup generating new RP keys")
                 new_key = solid.generate_keys()
                 backend.save_relying_party_keys(new_key)
+                backend.commit()
         else:
             print("Warning: Backend isn't ready yet")
 
@@ -52,26 +71,26 @@ def create_app():
 webserver_bp = flask.Blueprint('register', __name__)
 
 
+@webserver_bp.after_request
+def commit_backend(response):
+    # Backend save methods don't commit, so do it once for everything that a request saved
+    backend.commit()
+    return response
+
+
 @webserver_bp.route("/logo.png")
 def logo():
     return flask.current_app.send_static_file("solid-app-logo.png")
 
 
-@webserver_bp.route("/client/<string:cid>.jsonld")
-def client_id_url(cid):
-    # In Solid-OIDC you can register a client by having the "client_id" field be a URL to a json-ld document
-    # It's normally recommended that this is a static file, but for simplicity serve it from flask
-
-    baseurl = current_app.config['BASE_URL']
-    if not baseurl.endswith("/"):
-        baseurl += "/"
-
+@functools.lru_cache(maxsize=256)
+def _build_client_jsonld(cid, baseurl, redirect_url):
     client_information = {
         "@context": ["https://www.w3.org/ns/solid/oidc-context.jsonld"],
 
         "client_id": baseurl + f"client/{cid}.jsonld",
         "client_name": "Alastair's cool test application",
-        "redirect_uris": [current_app.config['REDIRECT_URL']],
+        "redirect_uris": [redirect_url],
         "post_logout_redirect_uris": [baseurl + "logout"],
         "client_uri": baseurl,
         "logo_uri": baseurl + "logo.png",
@@ -82,10 +101,25 @@ def client_id_url(cid):
         "default_max_age": 3600,
         "require_auth_time": True
     }
+    return json.dumps(client_information).encode("utf-8")
 
-    response = jsonify(client_information)
-    response.content_type = "application/ld+json"
-    return response
+
+@webserver_bp.route("/client/<string:cid>.jsonld")
+def client_id_url(cid):
+    # In Solid-OIDC you can register a client by having the "client_id" field be a URL to a json-ld document
+    # It's normally recommended that this is a static file, but for simplicity serve it from flask
+    # The document only depends on the cid and the config, so it's built once and providers can cache it
+
+    baseurl = current_app.config['BASE_URL']
+    if not baseurl.endswith("/"):
+        baseurl += "/"
+
+    body = _build_client_jsonld(cid, baseurl, current_app.config['REDIRECT_URL'])
+    response = current_app.response_class(body, mimetype="application/ld+json")
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    response.set_etag(str(zlib.adler32(body)))
+    return response.make_conditional(request)
 
 
 @webserver_bp.route("/")
@@ -156,6 +190,7 @@ def web_redirect():
 
     redirect_uri = current_app.config['REDIRECT_URL']
     always_use_client_url = current_app.config['ALWAYS_USE_CLIENT_URL']
+    # The RP key is read by the callback's prefetch, and solid.load_key only parses it once
     success, data = authentication_callback(backend, auth_code, state, provider, redirect_uri, always_use_client_url)
 
     if success:
@@ -0,0 +1,164 @@
+import json
+
+import jwcrypto.jwk
+import pytest
+import requests
+
+from trompasolid import authentication, solid
+
+PROVIDER = "https://idp.example/"
+
+
+class KeysBackend:
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.saved = []
+
+    def get_resource_server_configuration(self, provider):
+        return {"issuer": provider, "jwks_uri": provider + "jwks"}
+
+    def get_resource_server_keys(self, provider):
+        return self.jwks
+
+    def save_resource_server_keys(self, provider, keys):
+        self.saved.append(keys)
+        self.jwks = keys
+
+
+def make_jwks(*kids):
+    keys = [jwcrypto.jwk.JWK.generate(kty="EC", crv="P-256", kid=kid) for kid in kids]
+    return {"keys": [json.loads(key.export_public()) for key in keys]}
+
+
+@pytest.fixture(autouse=True)
+def clear_key_caches():
+    authentication._JWKS_INDEX_CACHE.clear()
+    authentication._JWKS_REFRESHED.clear()
+
+
+def test_get_provider_key():
+    backend = KeysBackend(make_jwks("a", "b"))
+    assert authentication.get_provider_key(backend, PROVIDER, "b")["kid"] == "b"
+
+
+def test_get_provider_key_rotated(monkeypatch):
+    backend = KeysBackend(make_jwks("old"))
+    downloads = []
+
+    def load_op_jwks(op_config, revalidate=False):
+        downloads.append(revalidate)
+        return make_jwks("new")
+
+    monkeypatch.setattr(solid, "load_op_jwks", load_op_jwks)
+
+    assert authentication.get_provider_key(backend, PROVIDER, "new")["kid"] == "new"
+    assert downloads == [True]
+    assert backend.saved and backend.saved[0]["keys"][0]["kid"] == "new"
+
+
+def test_get_provider_key_refresh_is_rate_limited(monkeypatch):
+    backend = KeysBackend(make_jwks("old"))
+    downloads = []
+
+    def load_op_jwks(op_config, revalidate=False):
+        downloads.append(revalidate)
+        return make_jwks("old")
+
+    monkeypatch.setattr(solid, "load_op_jwks", load_op_jwks)
+
+    assert authentication.get_provider_key(backend, PROVIDER, "unknown") is None
+    assert authentication.get_provider_key(backend, PROVIDER, "unknown") is None
+    assert len(downloads) == 1
+    assert backend.saved == []
+
+
+class NewProviderBackend:
+    def __init__(self):
+        self.saved = {}
+
+    def get_provider_bundle(self, provider):
+        return {"configuration": None, "keys": None, "registration": None}
+
+    def save_resource_server_configuration(self, provider, configuration):
+        self.saved["configuration"] = configuration
+
+    def save_resource_server_keys(self, provider, keys):
+        self.saved["keys"] = keys
+
+    def save_client_registration(self, provider, registration):
+        self.saved["registration"] = registration
+
+
+def test_generate_authentication_url_stops_before_registering_if_keys_fail(monkeypatch):
+    registrations = []
+
+    def load_op_jwks(op_config, revalidate=False):
+        raise requests.exceptions.ConnectionError("no keys")
+
+    monkeypatch.setattr(solid, "lookup_provider_from_profile", lambda url: PROVIDER)
+    monkeypatch.setattr(solid, "get_openid_configuration", lambda provider: {
+        "issuer": provider, "jwks_uri": provider + "jwks", "registration_endpoint": provider + "register"
+    })
+    monkeypatch.setattr(solid, "load_op_jwks", load_op_jwks)
+    monkeypatch.setattr(solid, "dynamic_registration", lambda *args: registrations.append(args))
+
+    backend = NewProviderBackend()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        authentication.generate_authentication_url(
+            backend, "https://alice.example/profile/card#me", "https://app.example/redirect"
+        )
+    assert registrations == []
+    assert "registration" not in backend.saved
+
+
+def test_generate_authentication_url_commits_new_registration(monkeypatch):
+    events = []
+
+    class RegisteringBackend(NewProviderBackend):
+        def save_client_registration(self, provider, registration):
+            events.append("save registration")
+
+        def commit(self):
+            events.append("commit")
+
+        def get_state_data(self, state):
+            return None
+
+        def set_state_data(self, state, code_verifier, issuer=None):
+            raise RuntimeError("state storage failed")
+
+    monkeypatch.setattr(solid, "lookup_provider_from_profile", lambda url: PROVIDER)
+    monkeypatch.setattr(solid, "get_openid_configuration", lambda provider: {
+        "issuer": provider, "jwks_uri": provider + "jwks", "registration_endpoint": provider + "register"
+    })
+    monkeypatch.setattr(solid, "load_op_jwks", lambda op_config, revalidate=False: make_jwks("a"))
+    monkeypatch.setattr(solid, "dynamic_registration", lambda *args: {"client_id": "client"})
+
+    with pytest.raises(RuntimeError):
+        authentication.generate_authentication_url(
+            RegisteringBackend(), "https://alice.example/profile/card#me", "https://app.example/redirect"
+        )
+    assert events == ["save registration", "commit"]
+
+
+def test_authentication_callback_rejects_state_for_another_provider(monkeypatch):
+    class StateBackend:
+        def prefetch(self, provider, relying_party_keys=True):
+            pass
+
+        def get_resource_server_configuration(self, provider):
+            return {"issuer": provider, "token_endpoint": provider + "token"}
+
+        def pop_state_data(self, state):
+            return {"code_verifier": "verifier", "issuer": "https://other.example/"}
+
+    def validate_auth_callback(*args, **kwargs):
+        raise AssertionError("the code shouldn't be exchanged")
+
+    monkeypatch.setattr(solid, "validate_auth_callback", validate_auth_callback)
+    key = jwcrypto.jwk.JWK.generate(kty="EC", crv="P-256")
+    success, _ = authentication.authentication_callback(
+        StateBackend(), "code", "state", PROVIDER, "https://app.example/redirect", always_use_client_url=True,
+        keypair=key
+    )
+    assert not success
@@ -0,0 +1,50 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql
+
+from trompasolid.backend.db_backend import DBBackend, PREFETCH_INFO_KEY
+
+
+def test_prefetched_data_is_forgotten_at_transaction_end():
+    engine = create_engine("sqlite://")
+    for end_transaction in (Session.commit, Session.rollback):
+        with Session(engine) as session:
+            backend = DBBackend(session)
+            session.execute(text("SELECT 1"))
+            session.info[PREFETCH_INFO_KEY] = {("registration", "https://idp.example/"): None}
+            assert backend._prefetched("registration", "https://idp.example/") is None
+
+            end_transaction(session)
+            assert PREFETCH_INFO_KEY not in session.info
+
+
+def test_only_the_backend_session_is_cleared():
+    engine = create_engine("sqlite://")
+    with Session(engine) as backend_session, Session(engine) as other_session:
+        DBBackend(backend_session)
+        other_session.execute(text("SELECT 1"))
+        other_session.info[PREFETCH_INFO_KEY] = {}
+        other_session.commit()
+        assert PREFETCH_INFO_KEY in other_session.info
+
+
+class RecordingSession:
+    def __init__(self):
+        self.info = {}
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return []
+
+
+def test_prefetch_without_relying_party_keys():
+    session = RecordingSession()
+    backend = DBBackend.__new__(DBBackend)
+    backend.session = session
+    backend.prefetch("https://idp.example/", relying_party_keys=False)
+    assert "FROM relying_party" not in session.statements[0]
+    assert ("relying_party_keys",) not in session.info[PREFETCH_INFO_KEY]
+
+    backend.prefetch("https://idp.example/")
+    assert "FROM relying_party" in session.statements[1]
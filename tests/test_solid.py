@@ -0,0 +1,231 @@
+import time
+
+import jwcrypto.jwk
+import jwcrypto.jwt
+import pytest
+import requests
+
+from trompasolid import solid
+
+ISSUER = "https://idp.example/"
+CLIENT_ID = "https://app.example/client/1.jsonld"
+KID = "key-1"
+
+
+def make_id_token(key, **claims):
+    now = int(time.time())
+    token_claims = {"iss": ISSUER, "aud": CLIENT_ID, "sub": "https://alice.example/profile/card#me",
+                    "iat": now, "exp": now + 300}
+    token_claims.update(claims)
+    token = jwcrypto.jwt.JWT(header={"alg": "ES256", "kid": KID}, claims=token_claims)
+    token.make_signed_token(key)
+    return token.serialize()
+
+
+@pytest.fixture
+def key():
+    return jwcrypto.jwk.JWK.generate(kty="EC", crv="P-256", kid=KID)
+
+
+def test_verify_id_token(key):
+    claims = solid.verify_id_token(make_id_token(key), key, ISSUER, CLIENT_ID)
+    assert claims["iss"] == ISSUER
+
+
+def test_verify_id_token_expired(key):
+    id_token = make_id_token(key, exp=int(time.time()) - 1000)
+    with pytest.raises(jwcrypto.jwt.JWTExpired):
+        solid.verify_id_token(id_token, key, ISSUER, CLIENT_ID)
+
+
+def test_verify_id_token_not_yet_valid(key):
+    id_token = make_id_token(key, nbf=int(time.time()) + 1000)
+    with pytest.raises(jwcrypto.jwt.JWTNotYetValid):
+        solid.verify_id_token(id_token, key, ISSUER, CLIENT_ID)
+
+
+def test_verify_id_token_wrong_issuer(key):
+    id_token = make_id_token(key, iss="https://other.example/")
+    with pytest.raises(jwcrypto.jwt.JWTInvalidClaimValue):
+        solid.verify_id_token(id_token, key, ISSUER, CLIENT_ID)
+
+
+PROFILE_PREFIXES = """@prefix solid: <http://www.w3.org/ns/solid/terms#>.
+@prefix foaf: <http://xmlns.com/foaf/0.1/>.
+"""
+
+
+def test_issuer_from_turtle():
+    profile = PROFILE_PREFIXES + "<#me> a foaf:Person; solid:oidcIssuer <https://idp.example/>.\n"
+    assert solid._issuer_from_turtle(profile) == "https://idp.example/"
+
+
+def test_issuer_from_turtle_full_iri():
+    profile = "<https://alice.example/profile/card#me> <http://www.w3.org/ns/solid/terms#oidcIssuer> " \
+              "<https://idp.example/> .\n"
+    assert solid._issuer_from_turtle(profile) == "https://idp.example/"
+
+
+def test_issuer_from_turtle_ignores_comments():
+    profile = PROFILE_PREFIXES + "# <#me> solid:oidcIssuer <https://old.example/> .\n" \
+                                 "<#me> solid:oidcIssuer <https://new.example/> .\n"
+    assert solid._issuer_from_turtle(profile) == "https://new.example/"
+
+
+def test_issuer_from_turtle_ignores_literals():
+    profile = PROFILE_PREFIXES + '<#me> foaf:name "solid:oidcIssuer <https://evil.example/>" ;\n' \
+                                 "    solid:oidcIssuer <https://idp.example/> .\n"
+    assert solid._issuer_from_turtle(profile) == "https://idp.example/"
+
+    profile = PROFILE_PREFIXES + '<#me> foaf:name """\nsolid:oidcIssuer <https://evil.example/>\n""" .\n'
+    assert solid._issuer_from_turtle(profile) is None
+
+
+def test_issuer_from_turtle_several_issuers():
+    # rdflib decides which one to use
+    profile = PROFILE_PREFIXES + "<#me> solid:oidcIssuer <https://a.example/>, <https://b.example/> .\n"
+    assert solid._issuer_from_turtle(profile) is None
+
+
+class FakeResponse:
+    def __init__(self, url, status_code=200, headers=None, text=""):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, content_type, text):
+        self.content_type = content_type
+        self.text = text
+
+    def head(self, url, **kwargs):
+        return FakeResponse(url)
+
+    def get(self, url, **kwargs):
+        return FakeResponse(url, headers={"Content-Type": self.content_type}, text=self.text)
+
+
+def test_fetch_issuer_invalid_rdf_xml(monkeypatch):
+    monkeypatch.setattr(solid, "_SESSION", FakeSession("application/rdf+xml", "<rdf:RDF not xml"))
+    assert solid._fetch_issuer("https://alice.example/profile/card") is None
+
+
+def test_fetch_issuer_not_rdf(monkeypatch):
+    monkeypatch.setattr(solid, "_SESSION", FakeSession("text/html", "<html></html>"))
+    assert solid._fetch_issuer("https://alice.example/profile/card") is None
+
+
+class TimeoutSession:
+    def head(self, url, **kwargs):
+        raise requests.exceptions.ConnectTimeout("timed out")
+
+
+def test_discover_issuer_does_not_remember_failed_requests(monkeypatch):
+    url = "https://timeout.example/profile/card#me"
+    monkeypatch.setattr(solid, "_SESSION", TimeoutSession())
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            solid.lookup_provider_from_profile(url)
+
+
+def test_discover_issuer_remembers_no_issuer(monkeypatch):
+    url = "https://noissuer.example/profile/card"
+    monkeypatch.setattr(solid, "_SESSION", FakeSession("text/turtle", "<#me> a <http://xmlns.com/foaf/0.1/Person> ."))
+    assert solid.lookup_provider_from_profile(url) is None
+    monkeypatch.setattr(solid, "_SESSION", TimeoutSession())
+    assert solid.lookup_provider_from_profile(url) is None
+
+
+ISSUER_LINK = "http://openid.net/specs/connect/1.0/issuer"
+
+
+@pytest.mark.parametrize("links, issuer", [
+    (f'<https://idp.example/>; rel="{ISSUER_LINK}"', "https://idp.example/"),
+    (f'<https://idp.example/>; rel={ISSUER_LINK}', "https://idp.example/"),
+    (f'<https://idp.example/>; rel="type {ISSUER_LINK}"', "https://idp.example/"),
+    (f'<https://idp.example/>; anchor="#me"; rel="{ISSUER_LINK}"', "https://idp.example/"),
+    (f'<https://alice.example/.acl>; rel="acl", <https://idp.example/>; rel="{ISSUER_LINK}"', "https://idp.example/"),
+    (f'<https://alice.example/.acl>; rel="acl",<https://idp.example/>;rel="{ISSUER_LINK}";title="x"',
+     "https://idp.example/"),
+    (f'<https://idp.example/>; rel="{ISSUER_LINK}x"', None),
+    (f'<https://idp.example/>; rel="{ISSUER_LINK}/more"', None),
+    ('<https://alice.example/.acl>; rel="acl"', None),
+    ("", None),
+    (None, None),
+])
+def test_issuer_from_link_header(links, issuer):
+    assert solid._issuer_from_link_header(links) == issuer
+
+
+class DocumentResponse:
+    def __init__(self, status_code, headers, content=b""):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class DocumentSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def document_cache():
+    solid._DOCUMENT_CACHE.clear()
+    yield
+    solid._DOCUMENT_CACHE.clear()
+
+
+def test_get_json_document_fresh_copy_is_reused(monkeypatch, document_cache):
+    session = DocumentSession(DocumentResponse(200, {"Cache-Control": "max-age=600"}, b'{"a": 1}'))
+    monkeypatch.setattr(solid, "_SESSION", session)
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 1}
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 1}
+    assert len(session.requests) == 1
+
+
+def test_get_json_document_revalidates_with_etag(monkeypatch, document_cache):
+    session = DocumentSession(
+        DocumentResponse(200, {"Cache-Control": "no-cache", "ETag": '"v1"'}, b'{"a": 1}'),
+        DocumentResponse(304, {"Cache-Control": "no-cache"}),
+    )
+    monkeypatch.setattr(solid, "_SESSION", session)
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 1}
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 1}
+    assert session.requests[1]["If-None-Match"] == '"v1"'
+
+
+def test_get_json_document_changed(monkeypatch, document_cache):
+    session = DocumentSession(
+        DocumentResponse(200, {"Cache-Control": "max-age=60", "Age": "100", "ETag": '"v1"'}, b'{"a": 1}'),
+        DocumentResponse(200, {"ETag": '"v2"'}, b'{"a": 2}'),
+    )
+    monkeypatch.setattr(solid, "_SESSION", session)
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 1}
+    # Age is more than max-age, so the first copy was already stale
+    assert solid._get_json_document("https://idp.example/jwks") == {"a": 2}
+
+
+@pytest.mark.parametrize("headers, max_age", [
+    ({}, solid.DEFAULT_DOCUMENT_MAX_AGE),
+    ({"Cache-Control": "public, max-age=600"}, 600),
+    ({"Cache-Control": "max-age=600", "Age": "100"}, 500),
+    ({"Cache-Control": "max-age=60", "Age": "100"}, 0),
+    ({"Cache-Control": "no-cache"}, 0),
+    ({"Cache-Control": "no-store, max-age=600"}, 0),
+])
+def test_document_max_age(headers, max_age):
+    assert solid._document_max_age(DocumentResponse(200, headers)) == max_age
@@ -1,17 +1,67 @@
-import json
+import functools
+import threading
 import zlib
 
-import jwcrypto.jwt
-import jwcrypto.jwk
+import requests
+from cachetools import TTLCache
 
 from trompasolid import solid
 from trompasolid.dpop import make_random_string
 
+# provider -> {kid: key} of the provider's parsed JWKS, so that we don't parse the keys for every login
+_JWKS_INDEX_CACHE = TTLCache(maxsize=256, ttl=3600)
+_JWKS_INDEX_LOCK = threading.Lock()
+# Providers whose keys we've downloaded again recently because a token was signed with a key that we
+# didn't know. Only do this once a minute per provider, so that bad tokens can't make us keep downloading
+JWKS_REFRESH_INTERVAL = 60
+_JWKS_REFRESHED = TTLCache(maxsize=256, ttl=JWKS_REFRESH_INTERVAL)
+
 
 class NoProviderError(Exception):
     pass
 
 
+def index_provider_keys(provider, jwks):
+    """Parse a provider's JWKS into a {kid: key} index and remember it for get_provider_key"""
+    jwks_index = solid.build_jwks_index(jwks)
+    with _JWKS_INDEX_LOCK:
+        _JWKS_INDEX_CACHE[provider] = jwks_index
+    return jwks_index
+
+
+def get_provider_key(backend, provider, kid):
+    """Get the key with id `kid` from a provider's JWKS, or None if the provider doesn't have it"""
+    with _JWKS_INDEX_LOCK:
+        jwks_index = _JWKS_INDEX_CACHE.get(provider)
+    key = solid.select_jwk_by_kid(jwks_index, kid) if jwks_index is not None else None
+    if key is None:
+        # Either we haven't loaded this provider's keys yet, or its keys have changed since we did
+        jwks_index = index_provider_keys(provider, backend.get_resource_server_keys(provider))
+        key = solid.select_jwk_by_kid(jwks_index, kid)
+    if key is None and _should_refresh_provider_keys(provider):
+        # The provider may have rotated its keys since we downloaded them
+        try:
+            provider_jwks = solid.load_op_jwks(backend.get_resource_server_configuration(provider), revalidate=True)
+        except requests.exceptions.RequestException as e:
+            print(f"Cannot download the keys of {provider}: {e}")
+            return None
+        jwks_index = index_provider_keys(provider, provider_jwks)
+        key = solid.select_jwk_by_kid(jwks_index, kid)
+        if key is not None:
+            backend.save_resource_server_keys(provider, provider_jwks)
+    return key
+
+
+def _should_refresh_provider_keys(provider):
+    with _JWKS_INDEX_LOCK:
+        if provider in _JWKS_REFRESHED:
+            return False
+        _JWKS_REFRESHED[provider] = True
+        return True
+
+
+# The same handful of issuers are seen over and over, only work out their client url once
+@functools.lru_cache(maxsize=512)
 def get_client_url_for_issuer(baseurl, issuer):
     if not baseurl.endswith("/"):
         baseurl += "/"
@@ -23,9 +73,12 @@ def get_client_url_for_issuer(baseurl, issuer):
 def generate_authentication_url(backend, webid, redirect_url, always_use_client_url=False):
     log_messages = []
 
-    if solid.is_webid(webid):
+    # If this isn't a web id with an issuer, the user gave us the url of a provider
+    try:
         provider = solid.lookup_provider_from_profile(webid)
-    else:
+    except requests.exceptions.HTTPError:
+        provider = None
+    if provider is None:
         provider = webid
 
     if not provider:
@@ -35,17 +88,21 @@ def generate_authentication_url(backend, webid, redirect_url, always_use_client_
     log_messages.append(f"Provider for this user is: {provider}")
     print(f"Provider for this user is: {provider}")
 
-    provider_config = backend.get_resource_server_configuration(provider)
-    provider_jwks = backend.get_resource_server_keys(provider)
+    bundle = backend.get_provider_bundle(provider)
+    provider_config = bundle["configuration"]
+    provider_jwks = bundle["keys"]
     if provider_config and provider_jwks:
         log_messages.append(f"Configuration for {provider} already exists, skipping setup")
         print(f"Configuration for {provider} already exists, skipping")
     else:
         provider_config = solid.get_openid_configuration(provider)
         backend.save_resource_server_configuration(provider, provider_config)
-
-        keys = solid.load_op_jwks(provider_config)
-        backend.save_resource_server_keys(provider, keys)
+        # Get the keys before registering, so that if they can't be downloaded we stop before
+        # the provider has a client registration that we wouldn't save
+        provider_jwks = solid.load_op_jwks(provider_config)
+        backend.save_resource_server_keys(provider, provider_jwks)
+        # The callback for this login will need these keys, parse them now while we have them
+        index_provider_keys(provider, provider_jwks)
 
         log_messages.append("Got configuration and jwks for provider")
 
@@ -58,13 +115,16 @@ def generate_authentication_url(backend, webid, redirect_url, always_use_client_
 
     if do_dynamic_registration:
         log_messages.append(f"Requested to do dynamic client registration")
-        client_registration = backend.get_client_registration(provider)
+        client_registration = bundle["registration"]
         if client_registration:
             # TODO: Check if redirect url is the same as the one configured here
             log_messages.append(f"Registration for {provider} already exists, skipping")
         else:
             client_registration = solid.dynamic_registration(provider, redirect_url, provider_config)
             backend.save_client_registration(provider, client_registration)
+            # The client now exists at the provider, so save it straight away instead of at the end of the
+            # request. If anything later fails, we'd otherwise lose it and register again next time
+            backend.commit()
 
             log_messages.append("Registered client with provider")
         client_id = client_registration["client_id"]
@@ -81,7 +141,7 @@ def generate_authentication_url(backend, webid, redirect_url, always_use_client_
     state = make_random_string()
 
     assert backend.get_state_data(state) is None
-    backend.set_state_data(state, code_verifier)
+    backend.set_state_data(state, code_verifier, provider)
 
     auth_url = solid.generate_authorization_request(
         provider_config,
@@ -94,7 +154,9 @@ def generate_authentication_url(backend, webid, redirect_url, always_use_client_
     return {"provider": provider, "auth_url": auth_url, "log_messages": log_messages}
 
 
-def authentication_callback(backend, auth_code, state, provider, redirect_uri, always_use_client_url=False):
+def authentication_callback(backend, auth_code, state, provider, redirect_uri, always_use_client_url=False,
+                            keypair=None):
+    backend.prefetch(provider, relying_party_keys=keypair is None)
     provider_config = backend.get_resource_server_configuration(provider)
 
     do_dynamic_registration = solid.op_can_do_dynamic_registration(provider_config) and not always_use_client_url
@@ -110,10 +172,16 @@ def authentication_callback(backend, auth_code, state, provider, redirect_uri, a
         client_id = get_client_url_for_issuer(redirect_uri, issuer)
         auth = None
 
-    code_verifier = backend.get_state_data(state)
+    backend_state = backend.pop_state_data(state)
 
-    keypair = solid.load_key(backend.get_relying_party_keys())
-    assert code_verifier is not None, f"state {state} not in backend?"
+    if keypair is None:
+        keypair = solid.load_key(backend.get_relying_party_keys())
+    assert backend_state is not None, f"state {state} not in backend?"
+    if backend_state["issuer"] not in (None, provider):
+        # The state was made for a login with a different provider, don't send its code verifier to this one
+        print(f"state {state} was created for a different provider")
+        return False, f"state {state} was created for a different provider"
+    code_verifier = backend_state["code_verifier"]
 
     success, resp = solid.validate_auth_callback(
         keypair, code_verifier, auth_code, provider_config, client_id, redirect_uri, auth
@@ -121,17 +189,11 @@ def authentication_callback(backend, auth_code, state, provider, redirect_uri, a
 
     if success:
         id_token = resp['id_token']
-        server_key = backend.get_resource_server_keys(provider)
-        # TODO: It seems like a server may give more than one key, is this the correct one?
-        # TODO: We need to load the jwt, and from its header find the "kid" (key id) parameter
-        #  from this, we can load through the list of server_key keys and find the key with this keyid
-        #  and then use that key to validate the message
-        key = server_key['keys'][0]
-        key = jwcrypto.jwk.JWK.from_json(json.dumps(key))
-        decoded_id_token = jwcrypto.jwt.JWT()
-        decoded_id_token.deserialize(id_token, key=key)
-
-        claims = json.loads(decoded_id_token.claims)
+        key = get_provider_key(backend, provider, solid.get_jwt_kid(id_token))
+        if key is None:
+            print(f"Cannot find the key that signed the id token in the keys of {provider}")
+            return False, resp
+        claims = solid.verify_id_token(id_token, key, provider_config["issuer"], client_id)
 
         if "webid" in claims:
             # The user's web id should be in the 'webid' key, but this doesn't always exist
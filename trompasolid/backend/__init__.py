@@ -7,6 +7,12 @@ class SolidBackend(ABC):
     def is_ready(self):
         pass
 
+    def commit(self):
+        """Persist everything that has been saved since the last commit.
+        Save methods don't commit on their own, so call this once at the end of a request or command.
+        Backends that write immediately don't need to override this"""
+        pass
+
     @abstractmethod
     def get_relying_party_keys(self):
         pass
@@ -35,10 +41,30 @@ class SolidBackend(ABC):
     def get_client_registration(self, provider):
         pass
 
+    def get_provider_bundle(self, provider):
+        """Get the configuration, keys, and client registration for a provider in one call.
+        Backends should override this if they can load them all at once"""
+        return {
+            "configuration": self.get_resource_server_configuration(provider),
+            "keys": self.get_resource_server_keys(provider),
+            "registration": self.get_client_registration(provider),
+        }
+
     @abstractmethod
     def save_client_registration(self, provider, registration):
         pass
 
+    @abstractmethod
+    def list_known_providers(self):
+        """Get the urls of all providers that we have stored configuration for"""
+        pass
+
+    def prefetch(self, provider, relying_party_keys=True):
+        """Load everything that we know about a provider, and the relying party keys unless
+        `relying_party_keys` is False, ahead of time so that the getters for them in the rest of
+        this request don't need to go to the backend again"""
+        pass
+
     @abstractmethod
     def save_configuration_token(self, issuer, profile, sub, token):
         pass
@@ -55,6 +81,11 @@ class SolidBackend(ABC):
     def get_configuration_tokens(self):
         pass
 
+    @abstractmethod
+    def get_issuer_for_profile(self, profile):
+        """Get the issuer of a configuration token that we have for a profile, or None if we don't have one"""
+        pass
+
     @abstractmethod
     def get_state_data(self, state):
         pass
@@ -64,5 +95,11 @@ class SolidBackend(ABC):
         pass
 
     @abstractmethod
-    def set_state_data(self, state, code_verifier):
+    def pop_state_data(self, state):
+        """Get the data for a state and delete it, so that it can only be used once.
+        Returns a dict with the keys `code_verifier` and `issuer`, or None if the state doesn't exist"""
+        pass
+
+    @abstractmethod
+    def set_state_data(self, state, code_verifier, issuer=None):
         pass
@@ -1,15 +1,30 @@
 import datetime
 
 import sqlalchemy.exc
+from sqlalchemy import delete, event, literal, select, union_all, update
+from sqlalchemy.dialects.postgresql import insert
 
 from trompasolid.backend import SolidBackend
 from trompasolid import db, model
 
+# Key in Session.info where values loaded by `DBBackend.prefetch` are kept. They're only valid for
+# the transaction that loaded them, and are removed when it ends
+PREFETCH_INFO_KEY = "trompasolid_prefetch"
+_NOT_PREFETCHED = object()
+
+
+def _forget_prefetched_data(session, transaction):
+    # Session.info outlives commit and rollback, so the rows could otherwise hide later changes
+    session.info.pop(PREFETCH_INFO_KEY, None)
+
 
 class DBBackend(SolidBackend):
 
     def __init__(self, session):
         self.session = session
+        # Only listen to our own session, not every session in the process
+        if not event.contains(session, "after_transaction_end", _forget_prefetched_data):
+            event.listen(session, "after_transaction_end", _forget_prefetched_data)
 
     def is_ready(self):
         # ProgrammingError is raised if the tables don't exist. Use this as
@@ -20,62 +35,108 @@ class DBBackend(SolidBackend):
         except sqlalchemy.exc.ProgrammingError:
             return False
 
+    def commit(self):
+        self.session.commit()
+
+    def _prefetched(self, *key):
+        return self.session.info.get(PREFETCH_INFO_KEY, {}).get(key, _NOT_PREFETCHED)
+
+    def _forget_prefetched(self, *key):
+        self.session.info.get(PREFETCH_INFO_KEY, {}).pop(key, None)
+
+    def prefetch(self, provider, relying_party_keys=True):
+        # Everything about the provider, and the relying party keys if they're needed, in one query
+        selects = self._provider_bundle_selects(provider)
+        kinds = ["configuration", "keys", "registration"]
+        if relying_party_keys:
+            selects.append(select(literal("relying_party_keys"), db.RelyingPartyKey.data).limit(1))
+            kinds.append("relying_party_keys")
+        prefetched = self.session.info.setdefault(PREFETCH_INFO_KEY, {})
+        rows = self._read_bundle(union_all(*selects), kinds)
+        if relying_party_keys:
+            prefetched[("relying_party_keys",)] = rows.pop("relying_party_keys")
+        for kind, data in rows.items():
+            prefetched[(kind, provider)] = data
+
+    def _upsert_provider_data(self, model, provider, data):
+        # There's one row per provider, so saving again replaces what we had
+        statement = insert(model).values(provider=provider, data=data)
+        self.session.execute(statement.on_conflict_do_update(
+            index_elements=[model.provider],
+            set_={"data": statement.excluded.data}
+        ))
+
     def get_relying_party_keys(self):
-        rp = self.session.query(db.RelyingPartyKey).first()
-        if rp:
-            return rp.data
-        else:
-            return None
+        data = self._prefetched("relying_party_keys")
+        if data is not _NOT_PREFETCHED:
+            return data
+        return self.session.execute(select(db.RelyingPartyKey.data).limit(1)).scalar()
 
     def save_relying_party_keys(self, keys):
+        self._forget_prefetched("relying_party_keys")
         rp = db.RelyingPartyKey(data=keys)
         self.session.add(rp)
-        self.session.commit()
 
     def get_resource_server_configuration(self, provider):
-        rsc = self.session.query(db.ResourceServerConfiguration).filter_by(provider=provider).first()
-        if rsc:
-            return rsc.data
-        else:
-            return None
+        data = self._prefetched("configuration", provider)
+        if data is not _NOT_PREFETCHED:
+            return data
+        return self.session.execute(
+            select(db.ResourceServerConfiguration.data).where(db.ResourceServerConfiguration.provider == provider).limit(1)
+        ).scalar()
 
     def save_resource_server_configuration(self, provider, configuration):
-        rsc = db.ResourceServerConfiguration(
-            provider=provider,
-            data=configuration
-        )
-        self.session.add(rsc)
-        self.session.commit()
+        self._forget_prefetched("configuration", provider)
+        self._upsert_provider_data(db.ResourceServerConfiguration, provider, configuration)
 
     def get_resource_server_keys(self, provider):
-        rsk = self.session.query(db.ResourceServerKeys).filter_by(provider=provider).first()
-        if rsk:
-            return rsk.data
-        else:
-            return None
+        data = self._prefetched("keys", provider)
+        if data is not _NOT_PREFETCHED:
+            return data
+        return self.session.execute(
+            select(db.ResourceServerKeys.data).where(db.ResourceServerKeys.provider == provider).limit(1)
+        ).scalar()
 
     def save_resource_server_keys(self, provider, keys):
-        rsk = db.ResourceServerKeys(
-            provider=provider,
-            data=keys
-        )
-        self.session.add(rsk)
-        self.session.commit()
+        self._forget_prefetched("keys", provider)
+        self._upsert_provider_data(db.ResourceServerKeys, provider, keys)
 
     def get_client_registration(self, provider):
-        cr = self.session.query(db.ClientRegistration).filter_by(provider=provider).first()
-        if cr:
-            return cr.data
-        else:
-            return None
+        data = self._prefetched("registration", provider)
+        if data is not _NOT_PREFETCHED:
+            return data
+        return self.session.execute(
+            select(db.ClientRegistration.data).where(db.ClientRegistration.provider == provider).limit(1)
+        ).scalar()
+
+    def list_known_providers(self):
+        return list(self.session.execute(select(db.ResourceServerConfiguration.provider)).scalars())
+
+    def _provider_bundle_selects(self, provider):
+        return [
+            select(literal("configuration"), db.ResourceServerConfiguration.data)
+            .where(db.ResourceServerConfiguration.provider == provider),
+            select(literal("keys"), db.ResourceServerKeys.data)
+            .where(db.ResourceServerKeys.provider == provider),
+            select(literal("registration"), db.ClientRegistration.data)
+            .where(db.ClientRegistration.provider == provider),
+        ]
+
+    def _read_bundle(self, query, kinds):
+        bundle = {kind: None for kind in kinds}
+        for kind, data in self.session.execute(query):
+            if bundle[kind] is None:
+                bundle[kind] = data
+        return bundle
+
+    def get_provider_bundle(self, provider):
+        # One query for all three tables instead of a query for each
+        query = union_all(*self._provider_bundle_selects(provider))
+        return self._read_bundle(query, ["configuration", "keys", "registration"])
 
     def save_client_registration(self, provider, registration):
-        cr = db.ClientRegistration(
-            provider=provider,
-            data=registration
-        )
-        self.session.add(cr)
-        self.session.commit()
+        self._forget_prefetched("registration", provider)
+        self._upsert_provider_data(db.ClientRegistration, provider, registration)
 
     def save_configuration_token(self, issuer, profile, sub, token):
         # In the case that the token already exists, update it
@@ -91,45 +152,58 @@ class DBBackend(SolidBackend):
                 data=token
             )
             self.session.merge(ct)
-            self.session.commit()
 
     def update_configuration_token(self, issuer, profile, token):
-        ct = self.session.query(db.ConfigurationToken).filter_by(issuer=issuer, profile=profile).first()
-        if ct:
-            ct.data = token
-            ct.added = datetime.datetime.now(tz=datetime.timezone.utc)
-            self.session.add(ct)
-            self.session.commit()
+        self.session.execute(
+            update(db.ConfigurationToken)
+            .where(db.ConfigurationToken.issuer == issuer, db.ConfigurationToken.profile == profile)
+            .values(data=token, added=datetime.datetime.now(tz=datetime.timezone.utc))
+        )
 
     def get_configuration_token(self, issuer, profile):
-        ct = self.session.query(db.ConfigurationToken).filter_by(issuer=issuer, profile=profile).first()
+        ct = self.session.execute(
+            select(db.ConfigurationToken)
+            .where(db.ConfigurationToken.issuer == issuer, db.ConfigurationToken.profile == profile)
+        ).scalars().first()
         if ct:
             return model.ConfigurationToken(issuer=ct.issuer, sub=ct.sub, profile=ct.sub, added=ct.added, data=ct.data)
         else:
             return None
 
     def get_configuration_tokens(self):
-        cts = self.session.query(db.ConfigurationToken).all()
+        cts = self.session.execute(select(db.ConfigurationToken)).scalars()
         return [model.ConfigurationToken(issuer=ct.issuer, sub=ct.sub, profile=ct.sub, added=ct.added, data=ct.data) for
                 ct in cts]
 
+    def get_issuer_for_profile(self, profile):
+        return self.session.execute(
+            # If the user has moved to a different provider, use the one they logged in with most recently
+            select(db.ConfigurationToken.issuer).where(db.ConfigurationToken.profile == profile)
+            .order_by(db.ConfigurationToken.added.desc()).limit(1)
+        ).scalar()
+
     def get_state_data(self, state):
-        st = self.session.query(db.State).filter_by(state=state).first()
-        if st:
-            return st.code_verifier
-        else:
-            return None
+        return self.session.execute(
+            select(db.State.code_verifier).where(db.State.state == state).limit(1)
+        ).scalar()
 
     def delete_state_data(self, state):
-        st = self.session.query(db.State).filter_by(state=state).first()
-        if st:
-            self.session.delete(st)
-            self.session.commit()
+        self.session.execute(delete(db.State).where(db.State.state == state))
+
+    def pop_state_data(self, state):
+        # Read and delete the row in one statement
+        row = self.session.execute(
+            delete(db.State).where(db.State.state == state).returning(db.State.code_verifier, db.State.issuer)
+        ).first()
+        if row:
+            return {"code_verifier": row.code_verifier, "issuer": row.issuer}
+        else:
+            return None
 
-    def set_state_data(self, state, code_verifier):
+    def set_state_data(self, state, code_verifier, issuer=None):
         st = db.State(
             state=state,
-            code_verifier=code_verifier
+            code_verifier=code_verifier,
+            issuer=issuer
         )
         self.session.add(st)
-        self.session.commit()
@@ -72,6 +72,19 @@ class RedisBackend(SolidBackend):
     def get_client_registration(self, provider):
         return self.get_redis_dict(make_redis_key(CONFIG_CLIENT_REGISTRATION, provider))
 
+    def list_known_providers(self):
+        prefix = REDIS_KEY_PREFIX + make_redis_key(CONFIG_RS_CONFIGURATION, "")
+        keys = self.redis_client.scan_iter(match=prefix + "*")
+        return [(key.decode() if isinstance(key, bytes) else key)[len(prefix):] for key in keys]
+
+    def get_provider_bundle(self, provider):
+        keys = [REDIS_KEY_PREFIX + make_redis_key(template, provider)
+                for template in (CONFIG_RS_CONFIGURATION, CONFIG_RS_JWKS, CONFIG_CLIENT_REGISTRATION)]
+        configuration, jwks, registration = [
+            json.loads(value) if value else None for value in self.redis_client.mget(keys)
+        ]
+        return {"configuration": configuration, "keys": jwks, "registration": registration}
+
     def save_client_registration(self, provider, client_registration):
         return self.store_redis_dict(make_redis_key(CONFIG_CLIENT_REGISTRATION, provider), client_registration)
 
@@ -81,13 +94,35 @@ class RedisBackend(SolidBackend):
     def get_configuration_token(self, issuer, profile):
         return self.get_redis_str(make_redis_key(CONFIG_TOKENS, issuer, profile))
 
+    def get_issuer_for_profile(self, profile):
+        # Tokens are only stored by issuer and profile, we can't look one up from just the profile
+        return None
+
     def get_state_data(self, state):
-        return self.get_redis_str(make_redis_key(CONFIG_STATE, state))
+        data = self.get_redis_dict(make_redis_key(CONFIG_STATE, state))
+        if data:
+            return data["code_verifier"]
+        else:
+            return None
 
     def delete_state_data(self, state):
         key = make_redis_key(CONFIG_STATE, state)
         key = REDIS_KEY_PREFIX + key
         return self.redis_client.delete(key)
 
-    def set_state_data(self, state, code_verifier):
-        return self.store_redis_str(make_redis_key(CONFIG_STATE, state), code_verifier)
+    def pop_state_data(self, state):
+        key = make_redis_key(CONFIG_STATE, state)
+        key = REDIS_KEY_PREFIX + key
+        # GET and DEL in a single transaction (GETDEL is only available from redis 6.2)
+        pipeline = self.redis_client.pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        data, _ = pipeline.execute()
+        if data:
+            return json.loads(data)
+        else:
+            return None
+
+    def set_state_data(self, state, code_verifier, issuer=None):
+        data = {"code_verifier": code_verifier, "issuer": issuer}
+        return self.store_redis_dict(make_redis_key(CONFIG_STATE, state), data)
@@ -1,3 +1,5 @@
+import functools
+
 import jwcrypto.jwk
 import jwcrypto.jwt
 
@@ -7,11 +9,30 @@ from trompasolid import solid
 
 
 backend: SolidBackend = None
+# The relying party key doesn't change while we're running, so it's only read from the backend once
+_relying_party_keys = None
 
 
 def set_backend(backend_):
-    global backend
+    global backend, _relying_party_keys
     backend = backend_
+    _relying_party_keys = None
+
+
+def _get_relying_party_keys():
+    global _relying_party_keys
+    if _relying_party_keys is None:
+        _relying_party_keys = backend.get_relying_party_keys()
+    return _relying_party_keys
+
+
+@functools.lru_cache(maxsize=4)
+def _load_signing_key(keydata):
+    # A separate copy from solid.load_key, so that setting alg doesn't change the key used elsewhere
+    private_key = jwcrypto.jwk.JWK.from_json(keydata)
+    # CSS Fails with a cryptic error if this field doesn't exist
+    private_key['alg'] = "RS256"
+    return private_key
 
 
 def get_bearer_for_user(provider, profile, url, method):
@@ -23,27 +44,27 @@ def get_bearer_for_user(provider, profile, url, method):
         raise ValueError("No configuration for this provider/user")
 
     access_token = configuration_token.data['access_token']
+    key = _get_relying_party_keys()
 
     if configuration_token.has_expired():
         print(f"Token for {profile} has expired, refreshing")
+        backend.prefetch(provider)
         client_registration = backend.get_client_registration(provider)
 
         refresh_token = configuration_token.data["refresh_token"]
-        keypair = solid.load_key(backend.get_relying_party_keys())
+        keypair = solid.load_key(key)
         provider_info = backend.get_resource_server_configuration(provider)
         status, resp = solid.refresh_auth_token(keypair, provider_info, client_registration["client_id"], refresh_token)
         if status:
             resp.update({"refresh_token": refresh_token})
             access_token = resp['access_token']
             backend.update_configuration_token(provider, profile, resp)
+            backend.commit()
             print("... refreshed")
         else:
             print("... refresh failed")
 
-    key = backend.get_relying_party_keys()
-    private_key = jwcrypto.jwk.JWK.from_json(key)
-    # CSS Fails with a cryptic error if this field doesn't exist
-    private_key['alg'] = "RS256"
+    private_key = _load_signing_key(key)
 
     headers = {
         'Authorization': ('DPoP ' + access_token),
@@ -1,10 +1,33 @@
 import datetime
+from typing import Optional
 
 from sqlalchemy import Index, Text, TIMESTAMP, func
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
+# Brings a database created by an older version up to date with these models (`flask upgrade-db`).
+# create_all only creates missing tables, it doesn't change existing ones.
+# Rows for the same provider are de-duplicated, keeping the newest, so that unique indexes can be created
+SCHEMA_UPGRADE_STATEMENTS = [
+    *[
+        stmt
+        for table in ("resource_server_configuration", "resource_server_keys", "client_registration")
+        for stmt in (
+            f"DELETE FROM {table} a USING {table} b WHERE a.provider = b.provider AND a.id < b.id",
+            f"DROP INDEX IF EXISTS ix_{table}_provider",
+            f"CREATE UNIQUE INDEX ix_{table}_provider ON {table} (provider)",
+        )
+    ],
+    "DELETE FROM pkce_state a USING pkce_state b WHERE a.state = b.state AND a.id < b.id",
+    "DROP INDEX IF EXISTS ix_pkce_state_state",
+    "CREATE UNIQUE INDEX ix_pkce_state_state ON pkce_state (state)",
+    "DROP INDEX IF EXISTS ix_pkce_state_code_verifier",
+    "ALTER TABLE pkce_state ADD COLUMN IF NOT EXISTS issuer text",
+    "CREATE INDEX IF NOT EXISTS configuration_token_idx_profile ON configuration_token (profile)",
+]
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -22,7 +45,7 @@ class RelyingPartyKey(Base):
 class ResourceServerConfiguration(Base):
     __tablename__ = 'resource_server_configuration'
     id: Mapped[int] = mapped_column(primary_key=True)
-    provider: Mapped[str] = mapped_column(Text, nullable=False, index=True)
+    provider: Mapped[str] = mapped_column(Text, nullable=False, index=True, unique=True)
     data: Mapped[dict] = mapped_column(postgresql.JSONB)
 
     def __repr__(self):
@@ -59,7 +82,8 @@ class ConfigurationToken(Base):
     data: Mapped[dict] = mapped_column(postgresql.JSONB)
     __table_args__ = (
         Index('configuration_token_idx_issuer_sub', "issuer", "sub", unique=True),
-        Index('configuration_token_idx_issuer_profile', "issuer", "profile", unique=True)
+        Index('configuration_token_idx_issuer_profile', "issuer", "profile", unique=True),
+        Index('configuration_token_idx_profile', "profile")
     )
 
     def __repr__(self):
@@ -69,8 +93,11 @@ class ConfigurationToken(Base):
 class State(Base):
     __tablename__ = 'pkce_state'
     id: Mapped[int] = mapped_column(primary_key=True)
-    state: Mapped[str] = mapped_column(Text, nullable=False, index=True)
-    code_verifier: Mapped[str] = mapped_column(Text, nullable=False, index=True)
+    state: Mapped[str] = mapped_column(Text, nullable=False, index=True, unique=True)
+    # Only ever read by looking up `state`, so it doesn't need an index
+    code_verifier: Mapped[str] = mapped_column(Text, nullable=False)
+    # The provider that the authorization request was sent to
+    issuer: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     def __repr__(self):
         return f'<State {self.id} ({self.state}, {self.code_verifier})>'
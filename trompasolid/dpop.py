@@ -1,9 +1,25 @@
-import base64
-import datetime
-import os
-import re
+import secrets
+import threading
+import time
 
 import jwcrypto.jwt
+from cachetools import LRUCache
+
+# id(keypair) -> (keypair, exported public key). Exporting serialises the key again each time,
+# but we sign many tokens with the same keypair. The keypair is kept in the value so that its id can't be reused
+_PUBLIC_JWK_CACHE = LRUCache(maxsize=8)
+_PUBLIC_JWK_LOCK = threading.Lock()
+
+
+def _public_jwk(keypair):
+    with _PUBLIC_JWK_LOCK:
+        cached = _PUBLIC_JWK_CACHE.get(id(keypair))
+    if cached is not None and cached[0] is keypair:
+        return cached[1]
+    public_jwk = keypair.export(private_key=False, as_dict=True)
+    with _PUBLIC_JWK_LOCK:
+        _PUBLIC_JWK_CACHE[id(keypair)] = (keypair, public_jwk)
+    return public_jwk
 
 
 def make_token_for(keypair, uri, method):
@@ -11,20 +27,20 @@ def make_token_for(keypair, uri, method):
         header={
             "typ": "dpop+jwt",
             "alg": "ES256",
-            "jwk": keypair.export(private_key=False, as_dict=True)
+            "jwk": _public_jwk(keypair)
         },
         claims={
            "jti": make_random_string(),
            "htm": method,
            "htu": uri,
-           "iat": int(datetime.datetime.now().timestamp())
+           "iat": int(time.time())
         }
     )
     jwt.make_signed_token(keypair)
     return jwt.serialize()
 
 
-def make_random_string():
-    x = base64.urlsafe_b64encode(os.urandom(40)).decode('utf-8')
-    x = re.sub('[^a-zA-Z0-9]+', '', x)
-    return x
+def make_random_string(nbytes=40):
+    # 40 random bytes gives a 54 character string. The url-safe alphabet only contains characters that are
+    # allowed in a PKCE code verifier (RFC 7636 section 4.1), so it can be used directly for verifiers and state
+    return secrets.token_urlsafe(nbytes)
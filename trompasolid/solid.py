@@ -1,79 +1,264 @@
 import base64
+import functools
 import hashlib
+import json
+import re
+import threading
+import time
 import urllib.parse
-from urllib.error import HTTPError
+import xml.sax
+from dataclasses import dataclass
+from typing import Optional
 
 import rdflib
 import requests
-import requests.utils
 import jwcrypto.jwk
 import jwcrypto.jwt
+from cachetools import LRUCache, TTLCache
 from oic.oic import Client as OicClient
 from oic.utils.authn.client import CLIENT_AUTHN_METHOD
+from rdflib.plugin import PluginException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from trompasolid.dpop import make_random_string, make_token_for
 
+# Seconds to wait for a provider or pod to respond
+HTTP_TIMEOUT = 10
+
+# A single session for all requests to providers and pods, so that connections are kept alive and
+# reused instead of doing a new TCP/TLS handshake for every request
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = "trompa-solid"
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+)
+_SESSION.mount("https://", _adapter)
+_SESSION.mount("http://", _adapter)
+
+# OP configuration and keys rarely change, so keep them in memory instead of fetching them on every lookup.
+# Keyed by the url that the document was loaded from. Entries are kept after they expire so that
+# we can ask the server if the document has changed instead of downloading it again
+_DOCUMENT_CACHE = LRUCache(maxsize=512)
+_CACHE_LOCK = threading.Lock()
+# How long to use a document for if the server doesn't tell us, in seconds
+DEFAULT_DOCUMENT_MAX_AGE = 3600
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+@dataclass
+class _CachedDocument:
+    data: dict
+    expires: float
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+def set_tls_verification(verify):
+    """Set if TLS certificates should be verified when connecting to a provider.
+    Only turn this off for testing, e.g. against a local provider with a self-signed certificate"""
+    _SESSION.verify = verify
+
+
+ISSUER_REL = 'http://openid.net/specs/connect/1.0/issuer'
+OIDC_ISSUER = rdflib.URIRef("http://www.w3.org/ns/solid/terms#oidcIssuer")
+# Formats that we can parse a profile document from, in order of preference
+PROFILE_ACCEPT = "text/turtle, application/ld+json;q=0.9, application/rdf+xml;q=0.8"
+
+# Used to find the issuer in a turtle profile without parsing the whole document
+_SOLID_PREFIX_RE = re.compile(r"(?:@prefix|PREFIX)\s+([\w.-]*):\s*<http://www\.w3\.org/ns/solid/terms#>", re.IGNORECASE)
+# An object list (solid:oidcIssuer <a>, <b>) isn't matched, rdflib decides which of those to use
+_OIDC_ISSUER_IRI_RE = re.compile(r"<http://www\.w3\.org/ns/solid/terms#oidcIssuer>\s+<([^>\s]+)>(?!\s*,)")
+# IRIs, string literals and comments in a turtle document. IRIs are matched so that a # inside one
+# isn't taken as the start of a comment
+_TURTLE_IRI_STRING_COMMENT_RE = re.compile(
+    r'<[^>\s]*>'
+    r'|"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\''
+    r'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+    r'|#[^\n]*'
+)
+# A link in a Link header with the issuer as one of its rels, quoted or not, e.g.
+# <https://idp.example/>; rel="http://openid.net/specs/connect/1.0/issuer"
+_ISSUER_LINK_RE = re.compile(
+    r'<([^>]*)>[^<]*?;\s*rel\s*=\s*"?(?:[^"<,]*\s)?' + re.escape(ISSUER_REL) + r'(?=[\s";,]|$)'
+)
+
+
+def _issuer_from_turtle(document):
+    """Look for a solid:oidcIssuer triple in a turtle document with a regular expression.
+    Only a single absolute issuer url is returned, anything more complex than that should be parsed with rdflib"""
+    # Text in comments and string literals isn't part of any triple, so remove it before searching
+    document = _TURTLE_IRI_STRING_COMMENT_RE.sub(
+        lambda m: m.group(0) if m.group(0).startswith("<") else ("" if m.group(0).startswith("#") else '""'),
+        document
+    )
+    candidates = set(_OIDC_ISSUER_IRI_RE.findall(document))
+    for prefix in _SOLID_PREFIX_RE.findall(document):
+        prefixed_re = r"(?<![\w.:-])" + re.escape(prefix) + r":oidcIssuer\s+<([^>\s]+)>(?!\s*,)"
+        candidates.update(re.findall(prefixed_re, document))
+    if len(candidates) == 1:
+        issuer = candidates.pop()
+        if urllib.parse.urlparse(issuer).scheme in ("http", "https"):
+            return issuer
+    return None
+
+
+def _issuer_from_link_header(links):
+    # We only care about one rel, so find it directly instead of parsing every link in the header
+    if links:
+        match = _ISSUER_LINK_RE.search(links)
+        if match:
+            return match.group(1).strip()
+    return None
+
+
+# Profile url -> issuer. The same users log in again and again, so remember the result instead of
+# looking it up every time.
+# Urls that don't have an issuer are remembered for a shorter time, so that repeated lookups of a
+# bad url don't each make requests to its server. A user's issuer very rarely changes, so a url with
+# an issuer is remembered for a day
+_ISSUER_CACHE = TTLCache(maxsize=2048, ttl=86400)
+_NO_ISSUER_CACHE = TTLCache(maxsize=10000, ttl=60)
+_ISSUER_CACHE_LOCK = threading.Lock()
+
+
+def _discover_issuer(url: str):
+    with _ISSUER_CACHE_LOCK:
+        if url in _NO_ISSUER_CACHE:
+            return None
+        issuer = _ISSUER_CACHE.get(url)
+    if issuer is not None:
+        return issuer
+
+    # A request that fails (timeout, connection error, server error) isn't an answer about whether the
+    # url has an issuer, so it's not remembered and the exception goes to the caller every time
+    issuer = _fetch_issuer(url)
+
+    with _ISSUER_CACHE_LOCK:
+        if issuer is None:
+            _NO_ISSUER_CACHE[url] = True
+        else:
+            _ISSUER_CACHE[url] = issuer
+    return issuer
+
+
+def _fetch_issuer(url: str):
+    # Solid servers advertise the issuer in a Link header, which we can read without downloading the profile
+    r = _SESSION.head(url, timeout=HTTP_TIMEOUT, allow_redirects=True)
+    if r.status_code == 404:
+        print("Cannot find a profile at this url")
+        return None
+    # Some servers don't support HEAD, in that case go straight to the GET below
+    if r.status_code not in (405, 501):
+        r.raise_for_status()
+        issuer = _issuer_from_link_header(r.headers.get('Link'))
+        if issuer:
+            return issuer
+
+    # If we get here, there was no rel in the headers. Instead, try and get the card
+    # and find its issuer
+    r = _SESSION.get(url, headers={"Accept": PROFILE_ACCEPT}, timeout=HTTP_TIMEOUT)
+    if r.status_code == 404:
+        print("Cannot find a profile at this url")
+        return None
+    r.raise_for_status()
+    issuer = _issuer_from_link_header(r.headers.get('Link'))
+    if issuer:
+        return issuer
+
+    content_type = r.headers.get("Content-Type", "text/turtle").split(";")[0].strip()
+    if content_type == "text/turtle":
+        # Most profiles are turtle, and we can normally find the issuer without building a graph
+        issuer = _issuer_from_turtle(r.text)
+        if issuer:
+            return issuer
+
+    # Parse the document that we already have instead of letting rdflib download it again,
+    # and tell it the format so that it doesn't have to guess
+    graph = rdflib.Graph()
+    try:
+        graph.parse(data=r.text, format=content_type, publicID=r.url)
+    except (PluginException, SyntaxError, ValueError, xml.sax.SAXException):
+        # Not an RDF format, or not a valid document, so this isn't a profile that we can use
+        return None
+    # We only need the first issuer, stop as soon as we find one
+    issuer = next(graph.objects(predicate=OIDC_ISSUER), None)
+    if issuer is not None:
+        return issuer.toPython()
+
+    return None
+
 
 def lookup_provider_from_profile(profile_url: str):
     """
 
     :param profile_url: The profile of the user, e.g.  https://alice.coolpod.example/profile/card#me
-    :return:
+    :return: the url of the user's OpenID provider, or None if the profile doesn't have one
     """
-
-    r = requests.options(profile_url)
-    r.raise_for_status()
-    links = r.headers.get('Link')
-    if links:
-        parsed_links = requests.utils.parse_header_links(links)
-        for l in parsed_links:
-            if l.get('rel') == 'http://openid.net/specs/connect/1.0/issuer':
-                return l['url']
-
-    # If we get here, there was no rel in the options. Instead, try and get the card
-    # and find its issuer
-    graph = rdflib.Graph()
-    try:
-        graph.parse(profile_url)
-        issuer = rdflib.URIRef("http://www.w3.org/ns/solid/terms#oidcIssuer")
-        triples = list(graph.triples((None, issuer, None)))
-        if triples:
-            # first item in the response, 3rd item in the triple
-            return triples[0][2].toPython()
-    except HTTPError as e:
-        if e.status == 404:
-            print("Cannot find a profile at this url")
-        else:
-            raise e
+    return _discover_issuer(profile_url)
 
 
 def is_webid(url: str):
-    """See if a URL is of a web id or a provider"""
-
-    # TODO: Duplicates `lookup_provider_from_profile`
-    # TODO: If we do this once, we can take advantage of it and also get the values
-    r = requests.options(url)
-    r.raise_for_status()
-    links = r.headers.get('Link')
-    if links:
-        parsed_links = requests.utils.parse_header_links(links)
-        for l in parsed_links:
-            if l.get('rel') == 'http://openid.net/specs/connect/1.0/issuer':
-                return True
-
-    # If we get here, there was no rel in the options. Instead, try and get the card
-    # and find its issuer
-    graph = rdflib.Graph()
+    """See if a URL is of a web id or a provider.
+    Not used in this package any more (call `lookup_provider_from_profile` and check for None instead),
+    but kept for users of the library"""
     try:
-        graph.parse(url)
-        issuer = rdflib.URIRef("http://www.w3.org/ns/solid/terms#oidcIssuer")
-        triples = list(graph.triples([None, issuer, None]))
-        if triples:
-            return True
-    except HTTPError:
-        pass
-
-    return False
+        return _discover_issuer(url) is not None
+    except requests.exceptions.HTTPError:
+        return False
+
+
+def _document_max_age(response):
+    cache_control = response.headers.get("Cache-Control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match:
+        # If the document came from a shared cache, it has already been stored there for `Age` seconds
+        age = response.headers.get("Age", "")
+        return max(int(match.group(1)) - (int(age) if age.isdigit() else 0), 0)
+    return DEFAULT_DOCUMENT_MAX_AGE
+
+
+def _get_json_document(url, revalidate=False):
+    """GET a json document. A cached copy is returned while it's fresh, once it expires we make a
+    conditional request and keep using the cached copy if the server says it hasn't changed.
+    If `revalidate` is set, check with the server even if the cached copy is still fresh"""
+    now = time.monotonic()
+    with _CACHE_LOCK:
+        cached = _DOCUMENT_CACHE.get(url)
+    if cached is not None and cached.expires > now and not revalidate:
+        return cached.data
+
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    r = _SESSION.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    if r.status_code == 304 and cached is not None:
+        document = _CachedDocument(
+            data=cached.data,
+            expires=now + _document_max_age(r),
+            etag=r.headers.get("ETag", cached.etag),
+            last_modified=r.headers.get("Last-Modified", cached.last_modified)
+        )
+    else:
+        r.raise_for_status()
+        document = _CachedDocument(
+            # json.loads takes the raw bytes, so the body isn't decoded to a str first
+            data=json.loads(r.content),
+            expires=now + _document_max_age(r),
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified")
+        )
+    with _CACHE_LOCK:
+        _DOCUMENT_CACHE[url] = document
+    return document.data
 
 
 def get_openid_configuration(op_url):
@@ -91,22 +276,19 @@ def get_openid_configuration(op_url):
     else:
         url = op_url + "/" + path
 
-    r = requests.get(url, verify=False)
-    r.raise_for_status()
-    return r.json()
+    return _get_json_document(url)
 
 
-def load_op_jwks(op_config):
+def load_op_jwks(op_config, revalidate=False):
     """
     Download an OP's JSON Web Key Set (jwks) based on a well-known configuration
     :param op_config: a config from `get_openid_configuration`
+    :param revalidate: ask the OP if its keys have changed even if we have a fresh copy of them
     :return:
     """
     if "jwks_uri" not in op_config:
         raise ValueError("Cannot find 'jwks_uri'")
-    r = requests.get(op_config["jwks_uri"], verify=False)
-    r.raise_for_status()
-    return r.json()
+    return _get_json_document(op_config["jwks_uri"], revalidate=revalidate)
 
 
 def generate_keys():
@@ -118,10 +300,52 @@ def generate_keys():
     return key.export_private()
 
 
+# The same relying party key is loaded for every request, only parse it once
+@functools.lru_cache(maxsize=4)
 def load_key(keydata):
     return jwcrypto.jwk.JWK.from_json(keydata)
 
 
+def build_jwks_index(jwks):
+    """Parse each key in a JSON Web Key Set, returning a dict of key id -> key"""
+    return {key.get("kid"): jwcrypto.jwk.JWK(**key) for key in jwks["keys"]}
+
+
+def select_jwk_by_kid(jwks_index, kid):
+    """Find the key with the given key id in an index from `build_jwks_index`, or None if it doesn't exist"""
+    if kid is None and len(jwks_index) == 1:
+        # If a provider only has one key, its tokens may not say which key they were signed with
+        return next(iter(jwks_index.values()))
+    return jwks_index.get(kid)
+
+
+def get_jwt_kid(token):
+    """Get the id of the key that was used to sign a JWT, without validating it"""
+    # Only decode the header, the token is fully parsed once when it's validated
+    header = token.split(".", 1)[0]
+    header = json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4)))
+    return header.get("kid")
+
+
+# Clock skew that we allow between us and the provider when checking token times, in seconds
+ID_TOKEN_LEEWAY = 60
+
+
+def verify_id_token(id_token, key, issuer, client_id):
+    """Check an id token's signature, that it was issued by `issuer` for `client_id`, and that it
+    hasn't expired. Returns the token's claims."""
+    # Listing any claims in check_claims turns off jwcrypto's default exp/nbf checks, so exp has to be
+    # listed too (None means compare it with the current time)
+    decoded = jwcrypto.jwt.JWT(
+        jwt=id_token, key=key, check_claims={"iss": issuer, "aud": client_id, "exp": None}
+    )
+    claims = json.loads(decoded.claims)
+    # nbf is optional, and everything in check_claims is required, so check it here if it's given
+    if "nbf" in claims and claims["nbf"] > time.time() + ID_TOKEN_LEEWAY:
+        raise jwcrypto.jwt.JWTNotYetValid(f"Token not yet valid ({claims['nbf']})")
+    return claims
+
+
 def op_can_do_dynamic_registration(op_config):
     return "registration_endpoint" in op_config
 
@@ -142,34 +366,39 @@ def dynamic_registration(provider, redirect_url, op_config):
 def make_verifier_challenge():
     code_verifier = make_random_string()
 
-    code_challenge = hashlib.sha256(code_verifier.encode('utf-8')).digest()
-    code_challenge = base64.urlsafe_b64encode(code_challenge).decode('utf-8')
-    code_challenge = code_challenge.replace('=', '')
+    # The verifier only contains url-safe base64 characters, so it is always ascii
+    digest = hashlib.sha256(code_verifier.encode('ascii')).digest()
+    code_challenge = base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
 
     return code_verifier, code_challenge
 
 
-def generate_authorization_request(configuration, redirect_url, client_id, state, code_challenge):
-    auth_url = configuration["authorization_endpoint"]
-
+@functools.lru_cache(maxsize=64)
+def _authorization_request_prefix(auth_url, redirect_url, client_id):
+    # Everything apart from the state and challenge is the same for every request to a provider
     query = urllib.parse.urlencode({
         "response_type": "code",
         "redirect_uri": redirect_url,
-        "code_challenge": code_challenge,
-        "state": state,
         "code_challenge_method": "S256",
         "client_id": client_id,
         # offline_access: also asks for refresh token
         "scope": "openid webid offline_access",
     })
+    return auth_url + '?' + query
+
+
+def generate_authorization_request(configuration, redirect_url, client_id, state, code_challenge):
+    auth_url = configuration["authorization_endpoint"]
 
-    url = auth_url + '?' + query
+    prefix = _authorization_request_prefix(auth_url, redirect_url, client_id)
+    # The state (make_random_string) and challenge (base64url) only contain url-safe characters
+    url = prefix + "&state=" + state + "&code_challenge=" + code_challenge
     return url
 
 
 def validate_auth_callback(keypair, code_verifier, auth_code, provider_info, client_id, redirect_uri, auth=None):
     # Exchange auth code for access token
-    resp = requests.post(
+    resp = _SESSION.post(
         url=provider_info['token_endpoint'],
         data={
             "grant_type": "authorization_code",
@@ -186,7 +415,8 @@ def validate_auth_callback(keypair, code_verifier, auth_code, provider_info, cli
         #  this is due to CSS or something during dynamic registration
         #  NSS doesn't seem to have this problem
         auth=auth,
-        allow_redirects=False)
+        allow_redirects=False,
+        timeout=HTTP_TIMEOUT)
     try:
         resp.raise_for_status()
         result = resp.json()
@@ -201,7 +431,7 @@ def validate_auth_callback(keypair, code_verifier, auth_code, provider_info, cli
 
 def refresh_auth_token(keypair, provider_info, client_id, refresh_token):
     # Exchange auth code for access token
-    resp = requests.post(
+    resp = _SESSION.post(
         url=provider_info['token_endpoint'],
         data={
             "grant_type": "refresh_token",
@@ -211,7 +441,8 @@ def refresh_auth_token(keypair, provider_info, client_id, refresh_token):
         headers={
             "DPoP": make_token_for(keypair, provider_info["token_endpoint"], "POST")
         },
-        allow_redirects=False)
+        allow_redirects=False,
+        timeout=HTTP_TIMEOUT)
     try:
         resp.raise_for_status()
         result = resp.json()